@@ -3,20 +3,28 @@ TimeCare Pool Schedule Scraper with Webcal Feed
 Self-hosted solution to scrape work schedule and serve as webcal
 """
 import asyncio
+import gzip
+import html
+import json
+import logging
+import re
 import secrets
 import os
+import shutil
 import hmac
 import hashlib
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 
 import httpx
-from fastapi import FastAPI, HTTPException
+import orjson
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.responses import Response
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from icalendar import Calendar, Event
-from bs4 import BeautifulSoup
+from icalendar import Calendar
+import lxml.html
+from selectolax.lexbor import LexborHTMLParser
 import uvicorn
 
 # Configuration
@@ -38,33 +46,99 @@ else:
 
 DATA_DIR = Path("data")
 SCHEDULE_FILE = DATA_DIR / "schedule.ics"
+COOKIES_FILE = DATA_DIR / "cookies.json"
+EVENTS_INDEX_FILE = DATA_DIR / "events.json"
+HISTORY_RETENTION_DAYS = 90
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# Weeks to scrape relative to the current one, and how many to fetch at once
+SCHEDULE_WEEKS = range(-2, 12)
+SCHEDULE_CONCURRENCY = 4
 
 # Create data directory
 DATA_DIR.mkdir(exist_ok=True)
 
-# HTTP client with session management
-client = httpx.AsyncClient(timeout=30.0)
+# Logging - set LOG_LEVEL=DEBUG to see per-shift parsing details
+logger = logging.getLogger("timepool_webcal")
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s'))
+logger.addHandler(log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+# ASP.NET hidden inputs on the login page. Attributes are matched one by one
+# since they can come in either name/value or value/name order.
+INPUT_TAG_RE = re.compile(rb'<input\b[^>]*>', re.IGNORECASE)
+INPUT_ATTR_RE = re.compile(rb'([\w:-]+)\s*=\s*"([^"]*)"')
+
+# Shift ID in a shift's raw HTML, e.g. "ID: 12345" (possibly with markup before the number)
+SHIFT_ID_RE = re.compile(r'ID:(?:\s|&nbsp;|<[^>]*>)*([^\s<&]+)')
+
+# Static calendar properties written around the events
+ICS_HEADER = (
+    b"BEGIN:VCALENDAR\r\n"
+    b"VERSION:2.0\r\n"
+    b"PRODID:-//TimeCare Pool Schedule//EN\r\n"
+    b"CALSCALE:GREGORIAN\r\n"
+    b"METHOD:PUBLISH\r\n"
+    b"X-WR-CALNAME:Work Schedule\r\n"
+    b"X-WR-TIMEZONE:Europe/Stockholm\r\n"
+)
+ICS_FOOTER = b"END:VCALENDAR\r\n"
+
+# In-memory copy of the served calendar: (file key, bytes, gzipped bytes, ETag, mtime)
+_ICS_CACHE = None
+
+# HTTP client with session management. Everything goes to the same TimeCare
+# host, so keep one HTTP/2 connection alive and multiplex requests over it.
+# The transport owns http2/limits; AsyncClient ignores them when given a transport.
+client = httpx.AsyncClient(
+    timeout=30.0,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=4,
+            max_connections=10,
+            keepalive_expiry=300.0
+        ),
+        retries=2
+    ),
+    headers={'User-Agent': 'timepool-webcal/0.1.0'}
+)
+
+
+async def daily_scrape_loop():
+    """Run the schedule scrape every day at 06:00"""
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=6, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        await scrape_schedule()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown"""
     # Startup
+    load_cookies()
     await scrape_schedule()
     
     # Schedule daily scraping at 6 AM
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(scrape_schedule, 'cron', hour=6, minute=0)
-    scheduler.start()
+    scheduler_task = asyncio.create_task(daily_scrape_loop())
     
-    print(f"[{datetime.now()}] Scheduler started. Daily scrape at 06:00")
-    print(f"[{datetime.now()}] Your webcal URL: webcal://your-pi-address:8000/calendar/{CALENDAR_TOKEN}.ics")
-    print(f"[{datetime.now()}] Or HTTP: http://your-pi-address:8000/calendar/{CALENDAR_TOKEN}.ics")
+    logger.info("Scheduler started. Daily scrape at 06:00")
+    logger.info("Your webcal URL: webcal://your-pi-address:8000/calendar/%s.ics", CALENDAR_TOKEN)
+    logger.info("Or HTTP: http://your-pi-address:8000/calendar/%s.ics", CALENDAR_TOKEN)
     
     yield
     
     # Shutdown
-    scheduler.shutdown()
+    scheduler_task.cancel()
+    with suppress(asyncio.CancelledError):
+        await scheduler_task
+    save_cookies()
     await client.aclose()
 
 
@@ -72,6 +146,63 @@ async def lifespan(app: FastAPI):
 app = FastAPI(title="TimeCare Webcal Service", lifespan=lifespan)
 
 
+def load_cookies():
+    """Restore TimeCare session cookies saved by a previous run"""
+    if not COOKIES_FILE.exists():
+        return
+    
+    try:
+        with open(COOKIES_FILE, 'r') as f:
+            for cookie in json.load(f):
+                client.cookies.set(
+                    cookie['name'],
+                    cookie['value'],
+                    domain=cookie['domain'],
+                    path=cookie['path']
+                )
+        logger.info("Loaded %d saved session cookies", len(client.cookies.jar))
+    except Exception as e:
+        logger.warning("Could not load saved cookies: %s", e)
+
+
+def save_cookies():
+    """Persist TimeCare session cookies so the next run can skip the login"""
+    cookies = [
+        {'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path}
+        for cookie in client.cookies.jar
+    ]
+    try:
+        with open(COOKIES_FILE, 'w') as f:
+            json.dump(cookies, f)
+    except Exception as e:
+        logger.warning("Could not save session cookies: %s", e)
+
+
+def extract_hidden_fields(content):
+    """Extract hidden input name/value pairs from raw login page HTML"""
+    hidden_fields = {}
+    for tag in INPUT_TAG_RE.finditer(content):
+        attrs = {name.lower(): value for name, value in INPUT_ATTR_RE.findall(tag.group())}
+        if attrs.get(b'type', b'').lower() != b'hidden':
+            continue
+        if attrs.get(b'name') and b'value' in attrs:
+            hidden_fields[attrs[b'name'].decode()] = html.unescape(attrs[b'value'].decode())
+    return hidden_fields
+
+
+def parse_html(response):
+    """Parse a response with lxml, decoding it with the charset httpx settled on"""
+    parser = lxml.html.HTMLParser(encoding=response.encoding)
+    return lxml.html.fromstring(response.content, parser=parser)
+
+
+def needs_login(response):
+    """Check whether TimeCare bounced a request to the login page"""
+    if 'Login.aspx' in str(response.url):
+        return True
+    return response.is_redirect and 'Login.aspx' in response.headers.get('location', '')
+
+
 async def login_to_timecare():
     """Login to TimeCare Pool and return authenticated session"""
     try:
@@ -80,17 +211,11 @@ async def login_to_timecare():
         login_page = await client.get(login_url)
         
         if login_page.status_code != 200:
-            print(f"[{datetime.now()}] Failed to load login page: {login_page.status_code}")
+            logger.error("Failed to load login page: %s", login_page.status_code)
             return False
         
-        # Parse hidden form fields required by ASP.NET
-        soup = BeautifulSoup(login_page.text, 'html.parser')
-        
         # Extract all hidden fields (ViewState, ViewStateGenerator, EventValidation, etc.)
-        hidden_fields = {}
-        for hidden in soup.find_all('input', type='hidden'):
-            if hidden.get('name') and hidden.get('value') is not None:
-                hidden_fields[hidden['name']] = hidden['value']
+        hidden_fields = extract_hidden_fields(login_page.content)
         
         # Build login form data - use exact field names from the HTML
         login_data = {
@@ -114,184 +239,220 @@ async def login_to_timecare():
             follow_redirects=True
         )
         
-        # Debug: print response details
-        print(f"[{datetime.now()}] Login response status: {response.status_code}")
-        print(f"[{datetime.now()}] Login response URL: {response.url}")
+        # Debug: log response details
+        logger.debug("Login response status: %s", response.status_code)
+        logger.debug("Login response URL: %s", response.url)
         
         # Check if login was successful by looking for redirect or schedule page
         if response.status_code == 200:
             # Check if we're redirected away from login page
             if 'Login.aspx' not in str(response.url):
-                print(f"[{datetime.now()}] Successfully logged in to TimeCare")
+                logger.info("Successfully logged in to TimeCare")
+                save_cookies()
                 return True
             else:
                 # Still on login page - check for error message
-                error_soup = BeautifulSoup(response.text, 'html.parser')
-                validation_summary = error_soup.find('div', id='ctl00_ContentMain_ValidationSummary1')
-                if validation_summary and validation_summary.get('style') != 'display:none;':
-                    print(f"[{datetime.now()}] Login failed: {validation_summary.get_text(strip=True)}")
+                error_tree = parse_html(response)
+                validation_summary = error_tree.xpath('//div[@id="ctl00_ContentMain_ValidationSummary1"]')
+                if validation_summary and validation_summary[0].get('style') != 'display:none;':
+                    logger.error("Login failed: %s", validation_summary[0].text_content().strip())
                 else:
-                    print(f"[{datetime.now()}] Login failed: Still on login page")
+                    logger.error("Login failed: Still on login page")
                 return False
         else:
-            print(f"[{datetime.now()}] Login failed: {response.status_code}")
+            logger.error("Login failed: %s", response.status_code)
             return False
             
     except Exception as e:
-        print(f"[{datetime.now()}] Login error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Login error: %s", e)
         return False
 
 
+def parse_shift_datetime(date_str, time_str):
+    """Build a datetime from "YYYY-MM-DD" and "HH:MM" without going through strptime"""
+    hour, minute = time_str.split(':')
+    return datetime(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]), int(hour), int(minute))
+
+
+def parse_schedule_page(page_html):
+    """Parse booked shifts from one Schedule.aspx page"""
+    tree = LexborHTMLParser(page_html)
+    
+    schedule_entries = []
+    
+    # Find all shift entries (they're in collapsible divs)
+    shifts = tree.css('div[data-role="collapsible"]')
+    
+    logger.debug("Found %d total shift entries", len(shifts))
+    
+    for shift in shifts:
+        try:
+            # Find the parent li to get the date from the listview id
+            parent_ul = shift.parent
+            while parent_ul is not None and parent_ul.tag != 'ul':
+                parent_ul = parent_ul.parent
+            if parent_ul is None or not parent_ul.attributes.get('id'):
+                logger.debug("Shift has no parent ul with id, skipping")
+                continue
+            
+            # Extract date from ul id (e.g., "dayShifts-2025-10-17")
+            ul_id = parent_ul.attributes['id']
+            date_str = ul_id.replace('dayShifts-', '')
+            
+            # Get shift details from h6 header
+            h6 = shift.css_first('h6')
+            if h6 is None:
+                logger.debug("No h6 found in shift, skipping")
+                continue
+            
+            # Collect every row once: the first three are the h6 header, the rest are notes
+            rows = shift.css('div.calendarListRow')
+            if len(rows) < 3:
+                logger.debug("Not enough rows (%d), skipping", len(rows))
+                continue
+            
+            # Parse shift type, time, and location
+            shift_type = rows[0].text(strip=True)  # e.g., "Bokning" or "Tillgänglighet"
+            
+            # Filter out availability entries - only keep actual bookings
+            if shift_type == "Tillgänglighet":
+                logger.debug("Skipping availability entry (not a booking)")
+                continue
+            
+            logger.debug("Processing %s for %s", shift_type, date_str)
+            
+            time_info = rows[1].text(strip=True)   # e.g., "08:30-16:30 Rast 30"
+            location_code = rows[2].text(strip=True)    # e.g., "23 LärKan"
+            
+            # Parse time (format: "08:30-16:30")
+            time_parts = time_info.split('\n')[0].strip()  # Get just the time part
+            if '-' in time_parts:
+                start_time_str, end_time_str = time_parts.split('-')
+                start_time_str = start_time_str.strip()
+                end_time_str = end_time_str.strip()
+                
+                # Parse into datetime objects
+                start_dt = parse_shift_datetime(date_str, start_time_str)
+                end_dt = parse_shift_datetime(date_str, end_time_str)
+                
+                # Extract break time if present (e.g., "Rast 30")
+                break_time = ""
+                if "Rast" in time_info:
+                    break_parts = time_info.split("Rast")
+                    if len(break_parts) > 1:
+                        break_time = f"Rast {break_parts[1].strip()} min"
+                
+                # Get full address/location details if available
+                address_elem = shift.css_first('a[id*="lnkAddress"]')
+                full_address = ""
+                if address_elem is not None:
+                    full_address = address_elem.text(strip=True)
+                
+                # Get additional notes/description
+                notes = []
+                for div in rows[3:]:
+                    text = div.text(strip=True)
+                    # Skip the already captured info
+                    if text and text not in [shift_type, time_info, location_code] and not text.startswith('ID:'):
+                        # Don't add the address again if it's in a link
+                        if div.css_first('a') is None:
+                            notes.append(text)
+                
+                # Get shift ID if available
+                shift_ids = SHIFT_ID_RE.findall(shift.html)
+                shift_id = shift_ids[-1] if shift_ids else ""
+                
+                # Build comprehensive description
+                description_parts = [shift_type]
+                if location_code:
+                    description_parts.append(location_code)
+                if break_time:
+                    description_parts.append(break_time)
+                description = " - ".join(description_parts)
+                
+                # Build comprehensive location
+                location_parts = []
+                if full_address:
+                    location_parts.append(full_address)
+                elif location_code:
+                    location_parts.append(location_code)
+                location_str = ", ".join(location_parts)
+                
+                # Build notes section
+                notes_str = "\n".join(notes) if notes else ""
+                if shift_id:
+                    notes_str += f"\nID: {shift_id}" if notes_str else f"ID: {shift_id}"
+                
+                schedule_entries.append({
+                    'start': start_dt,
+                    'end': end_dt,
+                    'location': location_str,
+                    'summary': description,
+                    'description': notes_str,
+                })
+                
+                logger.debug("Added event: %s at %s", description, start_dt)
+                
+        except Exception as e:
+            logger.exception("Error parsing shift: %s", e)
+            continue
+    
+    return schedule_entries
+
+
 async def scrape_schedule():
-    """Scrape current week's schedule from TimeCare Pool"""
-    print(f"[{datetime.now()}] Starting schedule scrape...")
+    """Scrape the configured range of weeks from TimeCare Pool"""
+    logger.info("Starting schedule scrape...")
     
     try:
-        # Login
-        if not await login_to_timecare():
-            return
-        
-        # Get schedule page for current week
         today = datetime.now()
         
         # Fetch schedule - TimeCare shows the week when you pass a date
         schedule_url = f"{TIMECARE_URL}/TimePoolWeb/Mobile/Schedule.aspx"
-        schedule_response = await client.get(
-            schedule_url,
-            params={
-                "Date": today.strftime("%Y-%m-%d 00:00:00")
-            }
-        )
+        
+        async def fetch_week(week_date):
+            return await client.get(
+                schedule_url,
+                params={
+                    "Date": week_date.strftime("%Y-%m-%d 00:00:00")
+                }
+            )
+        
+        # Probe with the current week: reuse the saved session and only log in when TimeCare asks for it
+        schedule_response = await fetch_week(today)
+        if needs_login(schedule_response):
+            logger.info("Session expired or missing, logging in")
+            if not await login_to_timecare():
+                return
+            schedule_response = await fetch_week(today)
         
         if schedule_response.status_code != 200:
-            print(f"[{datetime.now()}] Failed to fetch schedule: {schedule_response.status_code}")
+            logger.error("Failed to fetch schedule: %s", schedule_response.status_code)
             return
         
-        # Parse schedule
-        soup = BeautifulSoup(schedule_response.text, 'html.parser')
-        
-        schedule_entries = []
+        # Fetch the remaining weeks concurrently, a few at a time
+        semaphore = asyncio.Semaphore(SCHEDULE_CONCURRENCY)
         
-        # Find all shift entries (they're in collapsible divs)
-        shifts = soup.find_all('div', attrs={'data-role': 'collapsible'})
+        async def fetch_week_limited(week_date):
+            async with semaphore:
+                return await fetch_week(week_date)
         
-        print(f"[{datetime.now()}] Found {len(shifts)} total shift entries")
+        week_dates = [today + timedelta(weeks=offset) for offset in SCHEDULE_WEEKS if offset != 0]
+        week_responses = await asyncio.gather(
+            *(fetch_week_limited(week_date) for week_date in week_dates),
+            return_exceptions=True
+        )
         
-        for shift in shifts:
-            try:
-                # Find the parent li to get the date from the listview id
-                parent_ul = shift.find_parent('ul')
-                if not parent_ul or not parent_ul.get('id'):
-                    print(f"[{datetime.now()}] Debug: Shift has no parent ul with id, skipping")
-                    continue
-                
-                # Extract date from ul id (e.g., "dayShifts-2025-10-17")
-                ul_id = parent_ul['id']
-                date_str = ul_id.replace('dayShifts-', '')
-                
-                # Get shift details from h6 header
-                h6 = shift.find('h6')
-                if not h6:
-                    print(f"[{datetime.now()}] Debug: No h6 found in shift, skipping")
-                    continue
-                
-                rows = h6.find_all('div', class_='calendarListRow')
-                if len(rows) < 3:
-                    print(f"[{datetime.now()}] Debug: Not enough rows ({len(rows)}), skipping")
-                    continue
-                
-                # Parse shift type, time, and location
-                shift_type = rows[0].get_text(strip=True)  # e.g., "Bokning" or "Tillgänglighet"
-                
-                # Filter out availability entries - only keep actual bookings
-                if shift_type == "Tillgänglighet":
-                    print(f"[{datetime.now()}] Debug: Skipping availability entry (not a booking)")
-                    continue
-                
-                print(f"[{datetime.now()}] Debug: Processing {shift_type} for {date_str}")
-                
-                time_info = rows[1].get_text(strip=True)   # e.g., "08:30-16:30 Rast 30"
-                location_code = rows[2].get_text(strip=True)    # e.g., "23 LärKan"
-                
-                # Parse time (format: "08:30-16:30")
-                time_parts = time_info.split('\n')[0].strip()  # Get just the time part
-                if '-' in time_parts:
-                    start_time_str, end_time_str = time_parts.split('-')
-                    start_time_str = start_time_str.strip()
-                    end_time_str = end_time_str.strip()
-                    
-                    # Parse into datetime objects
-                    start_dt = datetime.strptime(f"{date_str} {start_time_str}", "%Y-%m-%d %H:%M")
-                    end_dt = datetime.strptime(f"{date_str} {end_time_str}", "%Y-%m-%d %H:%M")
-                    
-                    # Extract break time if present (e.g., "Rast 30")
-                    break_time = ""
-                    if "Rast" in time_info:
-                        break_parts = time_info.split("Rast")
-                        if len(break_parts) > 1:
-                            break_time = f"Rast {break_parts[1].strip()} min"
-                    
-                    # Get full address/location details if available
-                    address_elem = shift.find('a', id=lambda x: x and 'lnkAddress' in x)
-                    full_address = ""
-                    if address_elem:
-                        full_address = address_elem.get_text(strip=True)
-                    
-                    # Get additional notes/description
-                    notes = []
-                    content_divs = shift.find_all('div', class_='calendarListRow')
-                    for div in content_divs:
-                        text = div.get_text(strip=True)
-                        # Skip the already captured info
-                        if text and text not in [shift_type, time_info, location_code] and not text.startswith('ID:'):
-                            # Don't add the address again if it's in a link
-                            if not div.find('a'):
-                                notes.append(text)
-                    
-                    # Get shift ID if available
-                    shift_id = ""
-                    id_text = shift.get_text()
-                    if "ID:" in id_text:
-                        shift_id = id_text.split("ID:")[-1].strip().split()[0]
-                    
-                    # Build comprehensive description
-                    description_parts = [shift_type]
-                    if location_code:
-                        description_parts.append(location_code)
-                    if break_time:
-                        description_parts.append(break_time)
-                    description = " - ".join(description_parts)
-                    
-                    # Build comprehensive location
-                    location_parts = []
-                    if full_address:
-                        location_parts.append(full_address)
-                    elif location_code:
-                        location_parts.append(location_code)
-                    location_str = ", ".join(location_parts)
-                    
-                    # Build notes section
-                    notes_str = "\n".join(notes) if notes else ""
-                    if shift_id:
-                        notes_str += f"\nID: {shift_id}" if notes_str else f"ID: {shift_id}"
-                    
-                    schedule_entries.append({
-                        'start': start_dt,
-                        'end': end_dt,
-                        'location': location_str,
-                        'summary': description,
-                        'description': notes_str,
-                    })
-                    
-                    print(f"[{datetime.now()}] Debug: Added event: {description} at {start_dt}")
-                    
-            except Exception as e:
-                print(f"[{datetime.now()}] Error parsing shift: {e}")
-                import traceback
-                traceback.print_exc()
+        # Parse schedule
+        schedule_entries = parse_schedule_page(schedule_response.text)
+        for week_date, response in zip(week_dates, week_responses):
+            if isinstance(response, Exception):
+                logger.warning("Failed to fetch schedule for week of %s: %s", week_date.date(), response)
+                continue
+            if response.status_code != 200:
+                logger.warning("Failed to fetch schedule for week of %s: %s", week_date.date(), response.status_code)
                 continue
+            schedule_entries.extend(parse_schedule_page(response.text))
         
         # Generate iCal file with merged events
         await generate_ical(schedule_entries)
@@ -299,96 +460,174 @@ async def scrape_schedule():
         # Save historical copy
         history_file = DATA_DIR / f"schedule_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ics"
         if SCHEDULE_FILE.exists():
-            import shutil
-            shutil.copy(SCHEDULE_FILE, history_file)
+            try:
+                # schedule.ics is always replaced, never rewritten, so a hardlink is a stable snapshot
+                os.link(SCHEDULE_FILE, history_file)
+            except OSError:
+                # Filesystem without hardlink support
+                shutil.copy(SCHEDULE_FILE, history_file)
+        prune_history()
         
-        print(f"[{datetime.now()}] Schedule scrape completed. Found {len(schedule_entries)} booking shifts.")
+        logger.info("Schedule scrape completed. Found %d booking shifts.", len(schedule_entries))
         
     except Exception as e:
-        print(f"[{datetime.now()}] Error during scrape: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error during scrape: %s", e)
 
 
-async def generate_ical(schedule_entries):
-    """Generate iCal file from schedule entries, merging with existing events"""
+def write_file_atomic(path, data):
+    """Write data to a temporary file and swap it into place"""
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def prune_history():
+    """Delete historical schedule copies older than the retention period"""
+    cutoff = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).timestamp()
+    removed = 0
+    for history_file in DATA_DIR.glob("schedule_*.ics"):
+        try:
+            if history_file.stat().st_mtime < cutoff:
+                history_file.unlink()
+                removed += 1
+        except OSError as e:
+            logger.warning("Could not prune %s: %s", history_file.name, e)
+    if removed:
+        logger.info("Pruned %d historical schedule files older than %d days", removed, HISTORY_RETENTION_DAYS)
+
+
+def escape_ics_text(value):
+    """Escape a TEXT property value (RFC 5545 section 3.3.11)"""
+    return (
+        value.replace('\\', '\\\\')
+        .replace(';', '\\;')
+        .replace(',', '\\,')
+        .replace('\r\n', '\\n')
+        .replace('\n', '\\n')
+    )
+
+
+def fold_ics_line(line):
+    """Fold a content line at 75 octets without splitting UTF-8 characters"""
+    encoded = line.encode()
+    parts = []
+    start = 0
+    limit = 75
+    while len(encoded) - start > limit:
+        end = start + limit
+        # Step back over UTF-8 continuation bytes
+        while encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end])
+        start = end
+        limit = 74  # Continuation lines start with a space
+    parts.append(encoded[start:])
+    return b"\r\n ".join(parts).decode() + "\r\n"
+
+
+def format_vevent(entry, uid, dtstamp):
+    """Serialize a schedule entry as a VEVENT block (dtstamp is pre-formatted UTC)"""
+    lines = [
+        "BEGIN:VEVENT",
+        f"SUMMARY:{escape_ics_text(entry.get('summary', 'Work Shift'))}",
+        f"DTSTART:{entry['start'].strftime('%Y%m%dT%H%M%S')}",
+        f"DTEND:{entry['end'].strftime('%Y%m%dT%H%M%S')}",
+        f"DTSTAMP:{dtstamp}",
+        f"UID:{uid}",
+    ]
+    
+    # Add description with all the extra details
+    if entry.get('description'):
+        lines.append(f"DESCRIPTION:{escape_ics_text(entry['description'])}")
     
-    # Load existing calendar if it exists
-    existing_events = {}
+    # Add location
+    if entry.get('location'):
+        lines.append(f"LOCATION:{escape_ics_text(entry['location'])}")
+    
+    # Mark as busy time
+    lines.append("TRANSP:OPAQUE")
+    lines.append("END:VEVENT")
+    return "".join(fold_ics_line(line) for line in lines)
+
+
+def load_event_index():
+    """Load the uid -> {dtstart, ics} event index, building it from the calendar file on first run"""
+    if EVENTS_INDEX_FILE.exists():
+        try:
+            with open(EVENTS_INDEX_FILE, 'rb') as f:
+                event_index = orjson.loads(f.read())
+            logger.info("Loaded %d existing events", len(event_index))
+            return event_index
+        except Exception as e:
+            logger.warning("Could not load event index: %s", e)
+    
+    # One-time migration: parse the existing calendar and keep each VEVENT as text
+    event_index = {}
     if SCHEDULE_FILE.exists():
         try:
             with open(SCHEDULE_FILE, 'rb') as f:
                 existing_cal = Calendar.from_ical(f.read())
-                for component in existing_cal.walk():
-                    if component.name == "VEVENT":
-                        uid = str(component.get('uid'))
-                        existing_events[uid] = component
-            print(f"[{datetime.now()}] Loaded {len(existing_events)} existing events")
+            for component in existing_cal.walk("VEVENT"):
+                dtstart = component.get('dtstart')
+                if not dtstart or not hasattr(dtstart.dt, 'date'):
+                    continue
+                event_date = dtstart.dt if isinstance(dtstart.dt, datetime) else datetime.combine(dtstart.dt, datetime.min.time())
+                event_index[str(component.get('uid'))] = {
+                    'dtstart': event_date.isoformat(),
+                    'ics': component.to_ical().decode(),
+                }
+            logger.info("Migrated %d existing events to the event index", len(event_index))
         except Exception as e:
-            print(f"[{datetime.now()}] Could not load existing calendar: {e}")
+            logger.warning("Could not load existing calendar: %s", e)
+    
+    return event_index
+
+
+async def generate_ical(schedule_entries):
+    """Generate iCal file from schedule entries, merging with existing events"""
     
-    # Create new calendar
-    cal = Calendar()
-    cal.add('prodid', '-//TimeCare Pool Schedule//EN')
-    cal.add('version', '2.0')
-    cal.add('x-wr-calname', 'Work Schedule')
-    cal.add('x-wr-timezone', 'Europe/Stockholm')
-    cal.add('calscale', 'GREGORIAN')
-    cal.add('method', 'PUBLISH')
+    # Load previously generated events
+    event_index = load_event_index()
     
     # Track new event UIDs
     new_event_uids = set()
+    # Format the shared DTSTAMP once rather than per event
+    dtstamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
     
     # Add new events
     for entry in schedule_entries:
-        event = Event()
-        event.add('summary', entry.get('summary', 'Work Shift'))
-        event.add('dtstart', entry['start'])
-        event.add('dtend', entry['end'])
-        
-        # Add location
-        if entry.get('location'):
-            event.add('location', entry['location'])
-        
-        # Add description with all the extra details
-        if entry.get('description'):
-            event.add('description', entry['description'])
-        
-        event.add('dtstamp', datetime.now())
-        
         # Generate unique ID for each event
         uid = f"{entry['start'].strftime('%Y%m%d%H%M%S')}@timepool.boras.se"
-        event.add('uid', uid)
         new_event_uids.add(uid)
         
-        # Mark as busy time
-        event.add('transp', 'OPAQUE')
-        
-        cal.add_component(event)
+        event_index[uid] = {
+            'dtstart': entry['start'].isoformat(),
+            'ics': format_vevent(entry, uid, dtstamp),
+        }
     
-    # Add existing events that are not in the new set (to preserve history)
+    # Keep existing events that are not in the new set (to preserve history)
     # Only keep events that are in the past or near future
     cutoff_date = datetime.now() - timedelta(days=90)  # Keep last 90 days
     merged_count = 0
     
-    for uid, old_event in existing_events.items():
+    for uid, old_event in list(event_index.items()):
         if uid not in new_event_uids:
             # Check if event is recent enough to keep
-            dtstart = old_event.get('dtstart')
-            if dtstart and hasattr(dtstart.dt, 'date'):
-                event_date = dtstart.dt if isinstance(dtstart.dt, datetime) else datetime.combine(dtstart.dt, datetime.min.time())
-                if event_date >= cutoff_date:
-                    cal.add_component(old_event)
-                    merged_count += 1
+            if datetime.fromisoformat(old_event['dtstart']) >= cutoff_date:
+                merged_count += 1
+            else:
+                del event_index[uid]
     
-    print(f"[{datetime.now()}] Merged {merged_count} historical events (kept last 90 days)")
+    logger.info("Merged %d historical events (kept last 90 days)", merged_count)
     
     # Write to file
-    with open(SCHEDULE_FILE, 'wb') as f:
-        f.write(cal.to_ical())
+    vevents = [event['ics'].encode() for event in event_index.values()]
+    write_file_atomic(SCHEDULE_FILE, b"".join([ICS_HEADER, *vevents, ICS_FOOTER]))
+    write_file_atomic(EVENTS_INDEX_FILE, orjson.dumps(event_index))
     
     total_events = len(schedule_entries) + merged_count
-    print(f"[{datetime.now()}] Generated iCal file with {len(schedule_entries)} new events and {merged_count} historical events (total: {total_events})")
+    logger.info("Generated iCal file with %d new events and %d historical events (total: %d)", len(schedule_entries), merged_count, total_events)
 
 
 @app.get("/")
@@ -401,32 +640,96 @@ async def root():
     }
 
 
+def is_valid_token(token):
+    """Compare a request token against CALENDAR_TOKEN in constant time"""
+    return hmac.compare_digest(token.encode(), CALENDAR_TOKEN.encode())
+
+
+def get_cached_calendar():
+    """Return the served calendar, re-reading the file only when it has been replaced"""
+    global _ICS_CACHE
+    stat = SCHEDULE_FILE.stat()
+    file_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if _ICS_CACHE is None or _ICS_CACHE[0] != file_key:
+        with open(SCHEDULE_FILE, "rb") as f:
+            cal_data = f.read()
+        cal_data_gzip = gzip.compress(cal_data, compresslevel=6, mtime=0)
+        etag = f'"{hashlib.blake2b(cal_data, digest_size=8).hexdigest()}"'
+        _ICS_CACHE = (file_key, cal_data, cal_data_gzip, etag, stat.st_mtime)
+    return _ICS_CACHE
+
+
+def accepts_gzip(accept_encoding):
+    """Check whether an Accept-Encoding header allows a gzip response"""
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() == 'gzip':
+            params = params.strip().lower()
+            if not params.startswith('q='):
+                return True
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
 @app.get("/calendar/{token}.ics")
-async def get_calendar(token: str):
+async def get_calendar(
+    token: str,
+    if_none_match: str | None = Header(default=None),
+    if_modified_since: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None)
+):
     """Serve the calendar feed with token authentication"""
-    if token != CALENDAR_TOKEN:
+    if not is_valid_token(token):
         raise HTTPException(status_code=404, detail="Not found")
     
     if not SCHEDULE_FILE.exists():
         raise HTTPException(status_code=503, detail="Calendar not yet generated")
     
-    with open(SCHEDULE_FILE, "rb") as f:
-        cal_data = f.read()
+    _, cal_data, cal_data_gzip, content_etag, mtime = get_cached_calendar()
+    etag = content_etag
+    headers = {
+        "Content-Disposition": "inline; filename=schedule.ics",
+        "Cache-Control": "public, max-age=3600",
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Vary": "Accept-Encoding",
+    }
+    
+    # Serve the pre-compressed copy when the client takes gzip and it actually helps
+    if accept_encoding and accepts_gzip(accept_encoding) and len(cal_data_gzip) < len(cal_data):
+        cal_data = cal_data_gzip
+        etag = f'{content_etag[:-1]}-gzip"'
+        headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+    
+    # Calendar clients poll with the ETag or date they already have. Either encoding's
+    # ETag counts as a match since both carry the same calendar.
+    # If-Modified-Since is only considered without If-None-Match (RFC 9110)
+    if if_none_match:
+        client_etags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        if '*' in client_etags or etag in client_etags or content_etag in client_etags:
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since:
+        try:
+            modified_since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            modified_since = None
+        if modified_since is not None and int(mtime) <= modified_since.timestamp():
+            return Response(status_code=304, headers=headers)
     
     return Response(
         content=cal_data,
         media_type="text/calendar",
-        headers={
-            "Content-Disposition": "inline; filename=schedule.ics",
-            "Cache-Control": "no-cache, no-store, must-revalidate",
-        }
+        headers=headers
     )
 
 
 @app.post("/refresh")
 async def manual_refresh(token: str):
     """Manual refresh endpoint (also protected by token)"""
-    if token != CALENDAR_TOKEN:
+    if not is_valid_token(token):
         raise HTTPException(status_code=404, detail="Not found")
     
     await scrape_schedule()
@@ -440,17 +743,20 @@ async def debug_login():
         login_url = f"{TIMECARE_URL}/TimePoolWeb/Mobile/Login.aspx"
         login_page = await client.get(login_url)
         
-        soup = BeautifulSoup(login_page.text, 'html.parser')
-        hidden_fields = {}
-        for hidden in soup.find_all('input', type='hidden'):
-            if hidden.get('name'):
-                hidden_fields[hidden['name']] = hidden.get('value', '')
+        # Full parse on purpose, as a cross-check of the regex scan used by login_to_timecare
+        tree = parse_html(login_page)
+        hidden_fields = {
+            hidden.get('name'): hidden.get('value', '')
+            for hidden in tree.xpath('//input[@type="hidden"]')
+            if hidden.get('name')
+        }
+        forms = tree.xpath('//form')
         
         return {
             "status": "login page loaded",
             "status_code": login_page.status_code,
             "hidden_fields": hidden_fields,
-            "form_action": soup.find('form')['action'] if soup.find('form') else None,
+            "form_action": forms[0].attrib['action'] if forms else None,
         }
     except Exception as e:
         return {"error": str(e)}
@@ -464,7 +770,7 @@ def main():
         with open(token_file, "w") as f:
             f.write(f"Your calendar token: {CALENDAR_TOKEN}\n")
             f.write(f"Your webcal URL: webcal://your-pi-address:8000/calendar/{CALENDAR_TOKEN}.ics\n")
-        print(f"[{datetime.now()}] Token saved to calendar_token.txt")
+        logger.info("Token saved to calendar_token.txt")
     
     # Run the FastAPI app
     uvicorn.run(app, host="0.0.0.0", port=8000)